@@ -1,13 +1,20 @@
-import os, base64, tempfile, time, json
+import os, asyncio, struct, time, logging, queue
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from io import BytesIO
+from logging.handlers import QueueHandler, QueueListener
 from typing import Optional, Tuple
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request
-from telegram import Update, InputFile
+from telegram import Bot, Update, InputFile
 from telegram.ext import Application, MessageHandler, CommandHandler, ContextTypes, filters
 import httpx
-from PIL import Image
+from cachetools import TTLCache
+import orjson
+import pybase64
+from PIL import Image, ImageOps
 
 # ---------- ENV ----------
 load_dotenv()
@@ -17,34 +24,163 @@ missing = [n for n, v in [("TG_BOT_TOKEN", BOT_TOKEN), ("GEMINI_API_KEY", GEMINI
 if missing:
     raise RuntimeError(f"Missing env: {', '.join(missing)}")
 
+# ---------- LOGGING ----------
+# пишем через очередь: запись в stderr делает поток QueueListener, а не event loop
+_LOG_QUEUE: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+LOG_LISTENER = QueueListener(_LOG_QUEUE, _log_handler)
+log = logging.getLogger("banana")
+log.addHandler(QueueHandler(_LOG_QUEUE))
+log.propagate = False
+_log_level = os.getenv("LOG_LEVEL", "").strip().upper()
+if _log_level not in logging.getLevelNamesMapping():
+    _log_level = "WARNING"  # пустое или опечатка — не падаем на импорте
+log.setLevel(logging.DEBUG if os.getenv("DEBUG_WEBHOOK") else _log_level)
+
 # ---------- MODELS & HTTP ----------
 PRIMARY_MODEL = "gemini-2.0-flash-exp"      # чаще доступна, умеет IMAGE
 SECONDARY_MODEL = "gemini-2.5-flash-image"  # пробуем следом
 API_ROOT = "https://generativelanguage.googleapis.com/v1beta"
-HEADERS = {"Content-Type": "application/json"}
+UPLOAD_ROOT = "https://generativelanguage.googleapis.com/upload/v1beta"
+# br раскодируется только с пакетом brotli (extra httpx[brotli])
+# ключ — в заголовке, а не в ?key=: URL попадает в тексты httpx-ошибок, а они — пользователю и в логи
+GEMINI_AUTH = {"x-goog-api-key": GEMINI_KEY}
+HEADERS = {"Content-Type": "application/json", "Accept-Encoding": "gzip, deflate, br", **GEMINI_AUTH}
+
+# один клиент на всё время жизни приложения: пул соединений, keep-alive, HTTP/2
+HTTP_CLIENT: httpx.AsyncClient | None = None
+# webhook отвечает сразу, поэтому ограничиваем число одновременных запросов к Gemini
+GEMINI_CONCURRENCY = 16
+GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
+# после 429 все запросы к Gemini ждут до этого момента (time.monotonic), а не долбят API параллельно
+_BACKOFF_UNTIL = 0.0
+RATE_LIMIT_RETRIES = 2
+DEFAULT_RETRY_AFTER = 2.0
+MAX_RETRY_AFTER = 30.0
+# гонка PRIMARY/SECONDARY вместо последовательных попыток: быстрее, но вдвое больше квоты
+RACE_MODELS = os.getenv("GEMINI_RACE_MODELS", "").lower() in ("1", "true", "yes")
+# крупные картинки грузим один раз через Files API, а не base64 внутри JSON каждой попытки
+FILES_API_THRESHOLD = int(os.getenv("GEMINI_FILES_THRESHOLD", str(4 * 1024 * 1024)))
 
 # ---------- MIME / IMAGE ----------
-def _ensure_image_and_mime(image_bytes: bytes) -> Tuple[bytes, str]:
+JPEG_MAGIC = b"\xff\xd8\xff"
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+# всё, что больше по длинной стороне, уменьшаем перед отправкой в Gemini
+MAX_DIM = int(os.getenv("MAX_DIM", "1536"))
+JPEG_QUALITY = 92
+# отдельный небольшой пул под PIL: декод/энкод грузят CPU, больше потоков, чем ядер, не поможет
+PIL_EXECUTOR = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="pil")
+# форматы, которые Gemini принимает как есть — их не перекодируем
+PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "MPO": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+# MPO — JPEG камер телефонов с доп. кадром/картой глубины; PIL отдаёт его отдельным форматом
+JPEG_FORMATS = ("JPEG", "MPO")
+# HEIF/HEIC PIL без плагина не открывает, поэтому узнаём их по brand в ftyp-боксе
+HEIF_BRANDS = {b"heic": "image/heic", b"heix": "image/heic", b"hevc": "image/heic", b"hevx": "image/heic",
+               b"mif1": "image/heif", b"msf1": "image/heif", b"heif": "image/heif"}
+# SOF-маркеры JPEG, в которых лежат размеры кадра
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _header_size(image_bytes: bytes | bytearray | memoryview) -> Optional[Tuple[int, int]]:
+    """Размеры JPEG/PNG из заголовка, без PIL. None — если не разобрали."""
+    if image_bytes[:8] == PNG_MAGIC and image_bytes[12:16] == b"IHDR":
+        return struct.unpack(">II", image_bytes[16:24])
+    if image_bytes[:3] != JPEG_MAGIC:
+        return None
+    i, n = 2, len(image_bytes)
+    while i + 9 < n:
+        if image_bytes[i] != 0xFF:
+            return None
+        marker = image_bytes[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in _JPEG_SOF:
+            h, w = struct.unpack(">HH", image_bytes[i + 5:i + 9])
+            return w, h
+        i += 2 + int.from_bytes(image_bytes[i + 2:i + 4], "big")
+    return None
+
+class _Sink:
+    """Минимальный file-like для PIL.save: копит байты в bytearray без копии на выходе."""
+    __slots__ = ("buf",)
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, b) -> int:
+        self.buf += b
+        return len(b)
+
+    def flush(self) -> None:
+        pass
+
+def _encode_image(im: Image.Image, src_format: str) -> Tuple[bytearray, str]:
+    # JPEG только если исходник и так был JPEG: скриншоты (PNG и пр.) остаются без потерь,
+    # иначе артефакты вокруг цифр и букв мешают правке
+    has_alpha = im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info
+    mode = "RGBA" if has_alpha else "RGB"
+    if im.mode != mode:
+        im = im.convert(mode)
+    sink = _Sink()
+    if src_format not in JPEG_FORMATS or has_alpha:
+        im.save(sink, format="PNG", compress_level=1, optimize=False)
+        return sink.buf, "image/png"
+    im.save(sink, format="JPEG", quality=JPEG_QUALITY)
+    return sink.buf, "image/jpeg"
+
+def _ensure_image_and_mime(image_bytes: bytes | bytearray | memoryview) -> Tuple[bytes | bytearray | memoryview, str]:
+    # JPEG/PNG узнаём по сигнатуре, PIL нужен только для прочих форматов и для уменьшения
+    hdr = bytes(image_bytes[:12])
+    if hdr[4:8] == b"ftyp" and hdr[8:12] in HEIF_BRANDS:
+        return image_bytes, HEIF_BRANDS[hdr[8:12]]
+    mime = None
+    if hdr.startswith(JPEG_MAGIC):
+        mime = "image/jpeg"
+    elif hdr.startswith(PNG_MAGIC):
+        mime = "image/png"
+    if mime:
+        size = _header_size(image_bytes)
+        if size and max(size) <= MAX_DIM:
+            return image_bytes, mime
     im = Image.open(BytesIO(image_bytes))
-    fmt = (im.format or "").upper()
-    if fmt in ("JPEG", "JPG"):
-        return image_bytes, "image/jpeg"
-    if fmt == "PNG":
-        return image_bytes, "image/png"
-    buf = BytesIO()
-    (im if im.mode in ("RGBA", "LA") else im.convert("RGB")).save(buf, format="PNG")
-    return buf.getvalue(), "image/png"
-
-def _parts(prompt: str, mime: str, b64data: str, with_role: bool):
+    src_format = (im.format or "").upper()
+    if max(im.size) > MAX_DIM:
+        # P/1 LANCZOS не ресайзит — их переводим заранее; прочие режимы конвертируем уже после
+        # thumbnail, чтобы JPEG декодировался через draft() в уменьшенном размере
+        if im.mode in ("P", "1"):
+            has_alpha = im.mode == "P" and "transparency" in im.info
+            im = im.convert("RGBA" if has_alpha else "RGB")
+        im.thumbnail((MAX_DIM, MAX_DIM), Image.Resampling.LANCZOS)
+        # при перекодировании тег Orientation теряется, поэтому поворачиваем пиксели сами
+        ImageOps.exif_transpose(im, in_place=True)
+        return _encode_image(im, src_format)
+    mime = PASSTHROUGH_FORMATS.get(src_format)
+    if mime:
+        return image_bytes, mime
+    return _encode_image(im, src_format)
+
+PROMPT_PREFIX = (
+    "Отредактируй изображение строго по инструкции. "
+    "Сохрани стиль исходного текста (шрифт, размер, цвет, выравнивание, трекинг). "
+    "Не изменяй остальные области изображения. "
+    "Инструкция: "
+)
+
+def _text_part(prompt: str) -> dict:
+    return {"text": PROMPT_PREFIX + prompt}
+
+def _inline_part(mime: str, b64data: str) -> dict:
+    return {"inline_data": {"mime_type": mime, "data": b64data}}
+
+def _file_part(mime: str, file_uri: str) -> dict:
+    return {"file_data": {"mime_type": mime, "file_uri": file_uri}}
+
+def _parts(prompt: str, image_part: dict, with_role: bool):
     base = {
         "parts": [
-            {"text": (
-                "Отредактируй изображение строго по инструкции. "
-                "Сохрани стиль исходного текста (шрифт, размер, цвет, выравнивание, трекинг). "
-                "Не изменяй остальные области изображения. "
-                "Инструкция: " + prompt
-            )},
-            {"inline_data": {"mime_type": mime, "data": b64data}}
+            _text_part(prompt),
+            image_part
         ]
     }
     if with_role:
@@ -62,66 +198,151 @@ def _extract_image_b64(data: dict) -> str:
             if "inline_data" in p and p["inline_data"].get("data"):
                 return p["inline_data"]["data"]
         # Если дошли сюда — модель ответила не картинкой (например, текстом с ошибкой)
-        short = json.dumps(parts, ensure_ascii=False)[:400]
+        short = orjson.dumps(parts).decode()[:400]
         raise RuntimeError(f"Модель вернула не изображение: {short}")
     except Exception as e:
         raise RuntimeError(f"Не удалось извлечь изображение из ответа: {e}")
 
-async def _post_model(model: str, payload: dict) -> dict:
-    async with httpx.AsyncClient(timeout=180) as client:
-        url = f"{API_ROOT}/models/{model}:generateContent?key={GEMINI_KEY}"
-        r = await client.post(url, headers=HEADERS, json=payload)
-        if r.status_code >= 400:
-            # логируем тело, чтобы видеть причину
-            print("GEMINI ERROR BODY:", r.text[:2000])
-        r.raise_for_status()
-        return r.json()
-
-async def gemini_edit(prompt: str, image_bytes: bytes) -> bytes:
-    img1, mime1 = _ensure_image_and_mime(image_bytes)
-    b64_1 = base64.b64encode(img1).decode()
-
-    # --- Попытка 1: PRIMARY_MODEL + responseModalities=["IMAGE"], с ролью user ---
-    payload1 = {
-        "contents": _parts(prompt, mime1, b64_1, with_role=True),
-        "responseModalities": ["IMAGE"]
-    }
+def _retry_after(r: httpx.Response) -> float:
     try:
-        data = await _post_model(PRIMARY_MODEL, payload1)
-        b64 = _extract_image_b64(data)
-        return base64.b64decode(b64)
-    except httpx.HTTPStatusError as e:
-        if not (e.response is not None and e.response.status_code == 400):
-            raise
-
-    # --- Попытка 2: SECONDARY_MODEL + responseModalities=["IMAGE"], с ролью user ---
-    payload2 = {
-        "contents": _parts(prompt, mime1, b64_1, with_role=True),
-        "responseModalities": ["IMAGE"]
-    }
+        return float(r.headers.get("retry-after", DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+async def _gemini_post(url: str, content: bytes, headers: dict = HEADERS) -> httpx.Response:
+    """
+    POST в Gemini под общим семафором: ждёт глобальный backoff и повторяет запрос после 429.
+    Статус не проверяет — это делает вызывающий.
+    """
+    global _BACKOFF_UNTIL
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        async with GEMINI_SEM:
+            delay = _BACKOFF_UNTIL - time.monotonic()
+            if delay > MAX_RETRY_AFTER:
+                # столько пользователя не держим и API не трогаем — сразу отдаём 429
+                r = httpx.Response(429, headers={"retry-after": f"{delay:.0f}"},
+                                   request=httpx.Request("POST", url))
+                break
+            if delay > 0:
+                await asyncio.sleep(delay)
+            r = await HTTP_CLIENT.post(url, headers=headers, content=content)
+        if r.status_code != 429:
+            break
+        # backoff фиксируем всегда, даже для длинных Retry-After, — стоят все запросы
+        _BACKOFF_UNTIL = max(_BACKOFF_UNTIL, time.monotonic() + _retry_after(r))
+        if attempt == RATE_LIMIT_RETRIES:
+            break
+    if r.status_code >= 400:
+        # логируем тело, чтобы видеть причину (только path — без query)
+        log.warning("Gemini %s HTTP %s: %s", r.request.url.path, r.status_code, r.text[:512])
+    return r
+
+async def _post_model(model: str, body: bytes) -> httpx.Response:
+    # body — уже сериализованный JSON: так в памяти не висят одновременно dict и его копия
+    return await _gemini_post(f"{API_ROOT}/models/{model}:generateContent", body)
+
+async def _upload_file(data: bytes | bytearray | memoryview, mime: str) -> str:
+    """
+    Загружает картинку в Gemini Files API (resumable: start + upload/finalize).
+    Возвращает file.uri для file_data; файлы Gemini удаляет сам через 48 часов.
+    """
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    start = await _gemini_post(
+        f"{UPLOAD_ROOT}/files",
+        orjson.dumps({"file": {"display_name": "tg-image"}}),
+        {
+            **HEADERS,
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(len(data)),
+            "X-Goog-Upload-Header-Content-Type": mime,
+        },
+    )
+    # без raise_for_status: его текст содержит URL загрузки
+    if start.status_code >= 400:
+        raise RuntimeError(f"Gemini upload start: HTTP {start.status_code}")
+    r = await _gemini_post(
+        start.headers["x-goog-upload-url"],
+        data,
+        {**GEMINI_AUTH, "X-Goog-Upload-Command": "upload, finalize", "X-Goog-Upload-Offset": "0"},
+    )
+    if r.status_code >= 400:
+        raise RuntimeError(f"Gemini upload: HTTP {r.status_code}")
+    return orjson.loads(r.content)["file"]["uri"]
+
+# ответы крупнее этого разбираем в потоке, чтобы парсинг и base64 не держали event loop
+OFFLOAD_DECODE_BYTES = 1024 * 1024
+
+def _decode_image_response(content: bytes) -> bytes:
+    b64 = _extract_image_b64(orjson.loads(content))
+    # в base64 от Gemini нет пробелов и чужих символов — валидация не нужна
+    return pybase64.b64decode(b64, validate=False)
+
+async def _edit_with_model(model: str, body: bytes) -> Tuple[Optional[bytes], str]:
+    """
+    (картинка, "") при успехе, (None, тело ответа) при 400 — это обычный путь фолбэка,
+    поэтому без исключений. Прочие HTTP-ошибки пробрасывает.
+    """
+    r = await _post_model(model, body)
+    if r.status_code == 400:
+        return None, r.text[:400]
+    r.raise_for_status()
+    if len(r.content) > OFFLOAD_DECODE_BYTES:
+        return await asyncio.to_thread(_decode_image_response, r.content), ""
+    return _decode_image_response(r.content), ""
+
+async def _race_models(attempts: list[tuple[str, bytes]]) -> Tuple[Optional[bytes], str]:
+    """
+    Запускает попытки параллельно и возвращает первую удачную, остальные отменяет.
+    Если удачных нет — пробрасывает первую ошибку, иначе (None, тело последней 400).
+    """
+    tasks = [asyncio.create_task(_edit_with_model(m, p)) for m, p in attempts]
+    pending = set(tasks)
     try:
-        data = await _post_model(SECONDARY_MODEL, payload2)
-        b64 = _extract_image_b64(data)
-        return base64.b64decode(b64)
-    except httpx.HTTPStatusError as e2:
-        if not (e2.response is not None and e2.response.status_code == 400):
-            raise
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            ok = [t for t in done if t.exception() is None and t.result()[0] is not None]
+            if ok:
+                return ok[0].result()
+    finally:
+        for t in pending:
+            t.cancel()
+    for t in tasks:
+        if t.exception() is not None:
+            raise t.exception()
+    return tasks[-1].result()
 
+async def gemini_edit(prompt: str, image_bytes: bytes | bytearray | memoryview) -> bytes:
+    # PIL — CPU-работа, уносим её из event loop
+    img1, mime1 = await asyncio.get_running_loop().run_in_executor(PIL_EXECUTOR, _ensure_image_and_mime, image_bytes)
+    if len(img1) > FILES_API_THRESHOLD:
+        image_part = _file_part(mime1, await _upload_file(img1, mime1))
+    else:
+        # base64 — ASCII, декод в str для JSON это просто копия байтов
+        image_part = _inline_part(mime1, pybase64.b64encode(img1).decode("ascii"))
+    del img1
+
+    # contents (с мегабайтной base64-строкой) сериализуем один раз, тела попыток собираем склейкой
+    contents_json = orjson.dumps(_parts(prompt, image_part, with_role=True))
+    del image_part
+    # --- Попытки 1 и 2: PRIMARY_MODEL и SECONDARY_MODEL; тело одно и то же, меняется только URL ---
+    body1 = b'{"contents":' + contents_json + b',"responseModalities":["IMAGE"]}'
     # --- Попытка 3: SECONDARY_MODEL без responseModalities (некоторые конфиги так отвечают картинкой) ---
-    payload3 = {
-        "contents": _parts(prompt, mime1, b64_1, with_role=True)
-    }
-    try:
-        data = await _post_model(SECONDARY_MODEL, payload3)
-        b64 = _extract_image_b64(data)
-        return base64.b64decode(b64)
-    except httpx.HTTPStatusError as e3:
-        body = ""
-        try:
-            body = e3.response.text[:400]
-        except Exception:
-            pass
-        raise RuntimeError(f"Gemini 400: {body or 'Bad Request'}")
+    body3 = b'{"contents":' + contents_json + b'}'
+    del contents_json
+    # этапы фолбэка: попытки внутри этапа идут параллельно, этапы — по очереди до первой картинки
+    if RACE_MODELS:
+        stages = [[(PRIMARY_MODEL, body1), (SECONDARY_MODEL, body1)], [(SECONDARY_MODEL, body3)]]
+    else:
+        # после 400 от 1 попытки 2 и 3 отличаются только формой запроса — шлём их вместе
+        stages = [[(PRIMARY_MODEL, body1)], [(SECONDARY_MODEL, body1), (SECONDARY_MODEL, body3)]]
+    err = ""
+    for attempts in stages:
+        out, err = await _race_models(attempts)
+        if out is not None:
+            return out
+    raise RuntimeError(f"Gemini 400: {err or 'Bad Request'}")
 
 # ---------- FastAPI + PTB ----------
 app = FastAPI(title="Banana TG Bot")
@@ -138,35 +359,68 @@ HELP_TEXT = (
     "• коэффициент 2.35 → 2.95\n"
 )
 
-LAST_PHOTO: dict[int, tuple[bytes, int]] = {}
 TTL_SECONDS = 10 * 60
+# бюджет в байтах, а не в штуках: документ-картинка может весить до 20 МБ
+MAX_PENDING_BYTES = 128 * 1024 * 1024
+# фото без подписи ждут текст; TTLCache сам выкидывает просроченные и вытесняет старые сверх бюджета
+LAST_PHOTO: TTLCache[int, bytes] = TTLCache(maxsize=MAX_PENDING_BYTES, ttl=TTL_SECONDS, getsizeof=len)
 
 def _set_last_photo(user_id: int, img: bytes) -> None:
-    LAST_PHOTO[user_id] = (img, int(time.time()))
+    LAST_PHOTO[user_id] = img
 
 def _pop_last_photo(user_id: int) -> Optional[bytes]:
-    rec = LAST_PHOTO.get(user_id)
-    if not rec: return None
-    img, ts = rec
-    if int(time.time()) - ts > TTL_SECONDS:
-        del LAST_PHOTO[user_id]
-        return None
-    del LAST_PHOTO[user_id]
-    return img
+    return LAST_PHOTO.pop(user_id, None)
 
 def _has_fresh_photo(user_id: int) -> bool:
-    rec = LAST_PHOTO.get(user_id)
-    return bool(rec and int(time.time()) - rec[1] <= TTL_SECONDS)
+    return user_id in LAST_PHOTO
+
+SWEEP_INTERVAL = 60
+
+async def _sweep_last_photo() -> None:
+    # TTLCache чистит просроченное только при обращении; без трафика фото висели бы в памяти
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        LAST_PHOTO.expire()
+
+USER_LOCKS: dict[int, asyncio.Lock] = {}
+_USER_LOCK_REFS: Counter[int] = Counter()
+
+@asynccontextmanager
+async def _user_lock(user_id: int):
+    # лок живёт, пока его кто-то держит или ждёт, — простаивающие не копятся
+    lock = USER_LOCKS.get(user_id)
+    if lock is None:
+        lock = USER_LOCKS[user_id] = asyncio.Lock()
+    _USER_LOCK_REFS[user_id] += 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _USER_LOCK_REFS[user_id] -= 1
+        if not _USER_LOCK_REFS[user_id]:
+            del _USER_LOCK_REFS[user_id]
+            del USER_LOCKS[user_id]
+
+async def _fetch_tg_file(tg_file) -> bytes:
+    # PTB отдаёт file_path уже полным URL; качаем общим клиентом, без своего пула PTB
+    # в file_path зашит токен бота — наружу (в логи PTB) уходит только статус, без URL и цепочки
+    try:
+        r = await HTTP_CLIENT.get(tg_file.file_path)
+    except httpx.HTTPError as e:
+        raise RuntimeError(f"Telegram file download failed: {type(e).__name__}") from None
+    if r.status_code >= 400:
+        raise RuntimeError(f"Telegram file download failed: HTTP {r.status_code}")
+    return r.content
 
 async def _download_best_photo(update: Update) -> Optional[bytes]:
     msg = update.message
     if not msg: return None
     if msg.photo:
         tg_file = await msg.photo[-1].get_file()
-        return await tg_file.download_as_bytearray()
+        return await _fetch_tg_file(tg_file)
     if msg.document and (msg.document.mime_type or "").startswith("image/"):
         tg_file = await msg.document.get_file()
-        return await tg_file.download_as_bytearray()
+        return await _fetch_tg_file(tg_file)
     return None
 
 # ---------- Handlers ----------
@@ -178,43 +432,43 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def on_photo_or_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id if update.effective_user else 0
-    caption = (update.message.caption or "").strip() if update.message else ""
-    img_bytes = await _download_best_photo(update)
-    if not img_bytes:
-        return
-    if caption:
+    # апдейты одного пользователя обрабатываем по очереди, разных — параллельно
+    async with _user_lock(user_id):
+        caption = (update.message.caption or "").strip() if update.message else ""
+        img_bytes = await _download_best_photo(update)
+        if not img_bytes:
+            return
+        if caption:
+            msg = await update.message.reply_text("Генерирую…")
+            try:
+                out = await gemini_edit(caption, img_bytes)
+                await update.message.reply_photo(photo=InputFile(BytesIO(out), filename="edit.png"))
+            except Exception as e:
+                await msg.edit_text(f"Ошибка: {e}")
+            return
+        _set_last_photo(user_id, img_bytes)
+        await update.message.reply_text("Фото получил ✅ Теперь пришли текст-инструкцию отдельным сообщением (до 10 минут).")
+
+async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id if update.effective_user else 0
+    # апдейты одного пользователя обрабатываем по очереди, разных — параллельно
+    async with _user_lock(user_id):
+        text = (update.message.text or "").strip() if update.message else ""
+        if not text:
+            return
+        if not _has_fresh_photo(user_id):
+            await update.message.reply_text("Сначала пришли изображение (фото или документ image/*), потом — текст-инструкцию.")
+            return
+        img_bytes = _pop_last_photo(user_id)
+        if not img_bytes:
+            await update.message.reply_text("Срок ожидания истёк. Пришли изображение заново.")
+            return
         msg = await update.message.reply_text("Генерирую…")
         try:
-            out = await gemini_edit(caption, bytes(img_bytes))
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-                tmp.write(out); path = tmp.name
-            await update.message.reply_photo(photo=InputFile(path))
+            out = await gemini_edit(text, img_bytes)
+            await update.message.reply_photo(photo=InputFile(BytesIO(out), filename="edit.png"))
         except Exception as e:
             await msg.edit_text(f"Ошибка: {e}")
-        return
-    _set_last_photo(user_id, bytes(img_bytes))
-    await update.message.reply_text("Фото получил ✅ Теперь пришли текст-инструкцию отдельным сообщением (до 10 минут).")
-
-async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id if update.effective_user else 0
-    text = (update.message.text or "").strip() if update.message else ""
-    if not text:
-        return
-    if not _has_fresh_photo(user_id):
-        await update.message.reply_text("Сначала пришли изображение (фото или документ image/*), потом — текст-инструкцию.")
-        return
-    img_bytes = _pop_last_photo(user_id)
-    if not img_bytes:
-        await update.message.reply_text("Срок ожидания истёк. Пришли изображение заново.")
-        return
-    msg = await update.message.reply_text("Генерирую…")
-    try:
-        out = await gemini_edit(text, bytes(img_bytes))
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            tmp.write(out); path = tmp.name
-        await update.message.reply_photo(photo=InputFile(path))
-    except Exception as e:
-        await msg.edit_text(f"Ошибка: {e}")
 
 def register_handlers(app_):
     app_.add_handler(CommandHandler("start", start))
@@ -226,28 +480,68 @@ def register_handlers(app_):
 register_handlers(tg_app)
 
 # ---------- Lifecycle ----------
+SWEEPER: asyncio.Task | None = None
+# tg_app.bot, привязанный на старте, — webhook не ищет атрибут на каждый апдейт
+BOT: Bot | None = None
+# сколько ждать незавершённые апдейты при остановке (Render даёт ~30 с после SIGTERM)
+SHUTDOWN_GRACE_SECONDS = 25
+
 @app.on_event("startup")
 async def _startup():
+    global HTTP_CLIENT, SWEEPER, BOT
+    LOG_LISTENER.start()
+    HTTP_CLIENT = httpx.AsyncClient(
+        timeout=180,
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    )
+    # прогрев: DNS + TLS до Gemini, чтобы первое фото не платило за handshake
+    try:
+        await HTTP_CLIENT.get(f"{API_ROOT}/models", headers=GEMINI_AUTH, timeout=5)
+    except Exception as e:
+        log.warning("Gemini warm-up failed: %s", e)
     await tg_app.initialize()
+    BOT = tg_app.bot
     await tg_app.start()
+    SWEEPER = asyncio.create_task(_sweep_last_photo())
 
 @app.on_event("shutdown")
 async def _shutdown():
+    # Telegram уже получил 200 на эти апдейты — даём им доработать до закрытия клиента и пула PIL
+    if BG_TASKS:
+        _, pending = await asyncio.wait(BG_TASKS, timeout=SHUTDOWN_GRACE_SECONDS)
+        if pending:
+            log.warning("shutdown: %d updates still running, dropping them", len(pending))
+    if SWEEPER is not None:
+        SWEEPER.cancel()
     await tg_app.stop()
     await tg_app.shutdown()
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+    PIL_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    LOG_LISTENER.stop()
 
 # ---------- Routes ----------
+# ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+BG_TASKS: set[asyncio.Task] = set()
+
+def _on_bg_task_done(task: asyncio.Task) -> None:
+    BG_TASKS.discard(task)
+    # ответ Telegram уже ушёл, так что ошибку фоновой задачи можно только залогировать
+    if not task.cancelled() and task.exception() is not None:
+        log.error("update processing failed", exc_info=task.exception())
+
 @app.get("/")
 def root():
     return {"ok": True, "status": "running"}
 
 @app.post("/webhook")
 async def webhook(request: Request):
-    data = await request.json()
-    try:
-        print("WEBHOOK UPDATE:", data.get("update_id"))
-    except Exception:
-        pass
-    update = Update.de_json(data, tg_app.bot)
-    await tg_app.process_update(update)
+    data = orjson.loads(await request.body())
+    log.debug("webhook update_id=%s", data.get("update_id"))
+    update = Update.de_json(data, BOT)
+    # отвечаем Telegram сразу, обработка (с походом в Gemini) идёт в фоне
+    task = asyncio.create_task(tg_app.process_update(update))
+    BG_TASKS.add(task)
+    task.add_done_callback(_on_bg_task_done)
     return {"ok": True}